@@ -1,19 +1,25 @@
 import logging
+from collections import deque
+from collections.abc import Callable
 from dataclasses import dataclass
-from threading import Thread
+from functools import lru_cache
+from threading import Event, Thread
 
 import numpy as np
+import numpy.typing as npt
 import pyqtgraph as pg
 from brainflow import (BoardShim, BrainFlowError, BrainFlowExitCodes,
                        BrainFlowPresets, DataFilter, DetrendOperations,
-                       FilterTypes, WindowOperations)
+                       FilterTypes)
 from pylsl import StreamInfo, StreamOutlet, cf_double64
 from pyqtgraph.Qt import QtCore, QtGui
 from scipy import signal
+from scipy.fft import next_fast_len, rfft
+from scipy.integrate import trapezoid
 from scipy.signal import welch # implement
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Channel:
     ch_number: int
     name: str
@@ -21,6 +27,199 @@ class Channel:
     display: bool
 
 
+@lru_cache(maxsize=4)
+def _psd_plan(nfft: int, sampling_rate: int, dtype: npt.DTypeLike = np.float64) -> tuple:
+    """Creates the Blackman-Harris welch window and the psd frequency axis for an fft size and sampling rate.
+    Results are cached and shared, so both arrays are made read-only.
+
+    :param nfft: Fft size, also the welch segment length.
+    :type nfft: int
+    :param sampling_rate: Sampling rate.
+    :type sampling_rate: int
+    :param dtype: Data type of the window, should match the data it is applied to, defaults to np.float64
+    :type dtype: npt.DTypeLike, optional
+    :return: Returns the window and the psd frequencies.
+    :rtype: tuple
+    """
+    window = signal.windows.blackmanharris(nfft).astype(dtype)
+    freqs = np.fft.rfftfreq(nfft, 1 / sampling_rate)
+    window.flags.writeable = False
+    freqs.flags.writeable = False
+    return window, freqs
+
+
+def _welch(block: npt.NDArray[np.floating], nfft: int, sampling_rate: int) -> tuple:
+    """Computes the welch psd along the last axis of block, with a Blackman-Harris window, segments of nfft samples
+    and 50% overlap, like Brainflow's get_psd_welch: segments are not detrended and the psd is normalised by
+    sampling_rate * nfft, not by the window power like scipy.signal.welch. The ffts of all segments of all channels
+    are done in one scipy.fft call, spread over all cpu cores.
+
+    :param block: Data, channels x samples, with at least nfft samples.
+    :type block: npt.NDArray[np.floating]
+    :param nfft: Fft size and segment length.
+    :type nfft: int
+    :param sampling_rate: Sampling rate.
+    :type sampling_rate: int
+    :return: Returns the psd frequencies and the psd, channels x frequencies.
+    :rtype: tuple
+    """
+    window, freqs = _psd_plan(nfft, sampling_rate, block.dtype)
+    segments = np.lib.stride_tricks.sliding_window_view(block, nfft, axis=-1)[..., ::nfft - nfft // 2, :]
+    segments = segments * window
+    spectrum = rfft(segments, n=nfft, axis=-1, workers=-1)
+    psd = (spectrum.real ** 2 + spectrum.imag ** 2).mean(axis=-2)
+    psd /= sampling_rate * nfft
+    # one-sided psd, double all but the DC and (for even nfft) the Nyquist bins.
+    psd[..., 1:nfft // 2 + nfft % 2] *= 2
+    return freqs, psd
+
+
+def _compute_metrics(pm_block: npt.NDArray[np.floating], sampling_rate: int, nfft: int,
+                     band_slices: list[slice], psd_df: float, good_mask: npt.NDArray[np.bool_],
+                     frontal_mask: npt.NDArray[np.bool_], parietal_mask: npt.NDArray[np.bool_]) -> tuple:
+    """Computes the psd, band powers and selfmade brain metrics of a block of filtered eeg data.
+    Works on all channels at once, the channel masks are aligned with the rows of pm_block.
+
+    :param pm_block: Filtered eeg data within the power metric window, channels x samples.
+    :type pm_block: npt.NDArray[np.floating]
+    :param sampling_rate: Eeg sampling rate.
+    :type sampling_rate: int
+    :param nfft: Welch fft size and segment length.
+    :type nfft: int
+    :param band_slices: Psd frequency slices of the delta, theta, alpha, beta and gamma bands.
+    :type band_slices: list[slice]
+    :param psd_df: Psd frequency resolution.
+    :type psd_df: float
+    :param good_mask: Channels that are used for the brain metrics.
+    :type good_mask: npt.NDArray[np.bool_]
+    :param frontal_mask: Frontal channels.
+    :type frontal_mask: npt.NDArray[np.bool_]
+    :param parietal_mask: Parietal channels.
+    :type parietal_mask: npt.NDArray[np.bool_]
+    :return: Returns psd frequencies, psd (channels x frequencies), band powers (channels x bands),
+        and the engagement index, frontal theta and parietal alpha summed over the good channels.
+    :rtype: tuple
+    """
+    freqs, psd = _welch(pm_block, nfft, sampling_rate)
+
+    bands = np.stack([trapezoid(psd[:, band], dx=psd_df, axis=1) for band in band_slices], axis=1)
+    _, theta, alpha, beta, gamma = bands.T
+
+    engagement_idx = float(np.sum(((beta / (theta + alpha)) / gamma)[good_mask]))
+    frontal_theta = float(np.sum((theta / gamma)[good_mask & frontal_mask]))
+    parietal_alpha = float(np.sum((alpha / gamma)[good_mask & parietal_mask]))
+    return freqs, psd, bands, engagement_idx, frontal_theta, parietal_alpha
+
+
+class RingBuffer:
+    """Fixed size ring buffer for multichannel data (channels x samples) that keeps the most recent samples.
+
+    :param n_channels: Number of channels.
+    :type n_channels: int
+    :param length: Number of samples to keep.
+    :type length: int
+    :param dtype: Data type of the buffer, defaults to np.float64
+    :type dtype: npt.DTypeLike, optional
+    """
+
+    def __init__(self, n_channels: int, length: int, dtype: npt.DTypeLike = np.float64) -> None:
+        self.data = np.zeros((n_channels, length), dtype=dtype)
+        self.length = length
+        self.cursor = 0  # position of the next sample to write
+        self.count = 0  # number of valid samples
+
+    def extend(self, chunk: npt.NDArray) -> None:
+        """Appends a chunk of samples (channels x samples), overwriting the oldest samples.
+
+        :param chunk: Samples to append.
+        :type chunk: npt.NDArray
+        """
+        n = chunk.shape[1]
+        if n >= self.length:
+            self.data[:] = chunk[:, -self.length:]
+            self.cursor = 0
+            self.count = self.length
+            return
+
+        end = self.cursor + n
+        if end <= self.length:
+            self.data[:, self.cursor:end] = chunk
+        else:
+            split = self.length - self.cursor
+            self.data[:, self.cursor:] = chunk[:, :split]
+            self.data[:, :end - self.length] = chunk[:, split:]
+        self.cursor = end % self.length
+        self.count = min(self.count + n, self.length)
+
+    def view(self, rows: npt.ArrayLike | None = None, n_samples: int | None = None) -> npt.NDArray:
+        """Returns the most recent valid samples of the selected rows in chronological order, as a new contiguous
+        array. The samples are copied straight out of the buffer, in at most two parts per row.
+
+        :param rows: Rows to return, defaults to None (all rows)
+        :type rows: npt.ArrayLike | None, optional
+        :param n_samples: Number of most recent samples to return, defaults to None (all valid samples)
+        :type n_samples: int | None, optional
+        :return: Returns the buffered samples, rows x samples.
+        :rtype: npt.NDArray
+        """
+        rows = range(len(self.data)) if rows is None else rows
+        count = self.count if n_samples is None else min(n_samples, self.count)
+        start = (self.cursor - count) % self.length
+        split = min(self.length - start, count)  # samples up to the end of the buffer, the rest wraps around
+
+        out = np.empty((len(rows), count), dtype=self.data.dtype)
+        for i, row in enumerate(rows):
+            out[i, :split] = self.data[row, start:start + split]
+            out[i, split:] = self.data[row, :count - split]
+        return out
+
+
+class ComputeWorker(QtCore.QObject):
+    """Calls a compute function on a timer and emits its results, meant to be moved to its own QThread
+    so the computations do not block the GUI thread.
+
+    At most one result is in flight: new results are dropped until result_drawn is called for the previous one,
+    so a slow GUI skips frames rather than queueing them up.
+
+    :param compute: Function that computes and returns the results, or None if there is nothing to emit.
+    :type compute: Callable[[], dict | None]
+    :param interval_ms: Timer interval in ms.
+    :type interval_ms: int
+    """
+    result_ready = QtCore.Signal(object)
+
+    def __init__(self, compute: Callable[[], dict | None], interval_ms: int) -> None:
+        super().__init__()
+        self.compute = compute
+        self.interval_ms = interval_ms
+        self.timer = None
+        self.drawn = Event()
+        self.drawn.set()
+
+    @QtCore.Slot()
+    def start(self) -> None:
+        # create the timer here, so it lives in the thread the worker was moved to.
+        self.timer = QtCore.QTimer(self)
+        self.timer.timeout.connect(self._tick)
+        self.timer.start(self.interval_ms)
+
+    @QtCore.Slot()
+    def stop(self) -> None:
+        if self.timer is not None:
+            self.timer.stop()
+
+    def result_drawn(self) -> None:
+        """Signals that the last emitted result has been drawn, thread-safe."""
+        self.drawn.set()
+
+    def _tick(self) -> None:
+        # always compute, it also pushes the power metric over LSL, but only emit if the GUI is ready for it.
+        result = self.compute()
+        if result is not None and self.drawn.is_set():
+            self.drawn.clear()
+            self.result_ready.emit(result)
+
+
 class IXRDashboard(Thread):
     """Class that implements a basic dashboard to
     display EEG, PPG, motion, brain waves, and ixr-flow metrics.
@@ -62,6 +261,15 @@ class IXRDashboard(Thread):
                              for i, ch_number in enumerate(eeg_description['eeg_channels'])]
         self.eeg_channels += [Channel(ch_number, 'Fpz', True, self.display_ref)
                               for ch_number in eeg_description['other_channels']]
+        # channel selections are fixed for the whole session, cache them as index arrays for fancy indexing.
+        # dtype=int keeps them valid indices when a selection is empty, e.g. for boards without reference channels.
+        # The indices point into the rows of the eeg ring buffer, which follow the order of eeg_channels.
+        self.eeg_rows = [ch.ch_number for ch in self.eeg_channels]
+        self.non_ref_channels = [ch for ch in self.eeg_channels if not ch.reference]
+        self.non_ref_idx = np.array([i for i, ch in enumerate(self.eeg_channels) if not ch.reference], dtype=int)
+        self.ref_idx = np.array([i for i, ch in enumerate(self.eeg_channels) if ch.reference], dtype=int)
+        self.display_channels = [ch for ch in self.eeg_channels if ch.display]
+        self.display_idx = np.array([i for i, ch in enumerate(self.eeg_channels) if ch.display], dtype=int)
         self.gyro_channels = BoardShim.get_gyro_channels(self.board_id, self.gyro_preset)
         self.ppg_channels = BoardShim.get_ppg_channels(self.board_id, self.ppg_preset)
         self.eeg_sampling_rate = BoardShim.get_sampling_rate(self.board_id, self.eeg_preset)
@@ -70,7 +278,50 @@ class IXRDashboard(Thread):
         self.update_speed_ms = 100
         self.plot_window_s = 20  # should always be bigger then power_metric_window_ms
         self.power_metric_window_s = 1.5  # should always be bigger then psd size
-        self.psd_size = DataFilter.get_nearest_power_of_two(self.eeg_sampling_rate)
+        self.pull_window_s = 1  # should always be bigger then update_speed_ms
+
+        # ring buffers with the plot window of the used channels, each update only adds the new samples from Brainflow.
+        # Eeg and gyro are processed in float32, which is precise enough and halves the memory traffic,
+        # ppg stays float64 since it is filtered with Brainflow's DataFilter, which only works on float64.
+        # Raw eeg is only needed for bad channel detection within the power metric window,
+        # the plot window of eeg is kept re-referenced and filtered.
+        self.eeg_buffer = RingBuffer(len(self.eeg_channels), int(self.power_metric_window_s * self.eeg_sampling_rate),
+                                     np.float32)
+        self.eeg_filtered_buffer = RingBuffer(len(self.eeg_channels),
+                                              int(self.plot_window_s * self.eeg_sampling_rate), np.float32)
+        self.gyro_buffer = RingBuffer(len(self.gyro_channels), int(self.plot_window_s * self.gyro_sampling_rate),
+                                      np.float32)
+        self.ppg_buffer = RingBuffer(1, int(self.plot_window_s * self.ppg_sampling_rate))
+        self.timestamp_channels = {preset: BoardShim.get_timestamp_channel(self.board_id, preset)
+                                   for preset in (self.eeg_preset, self.gyro_preset, self.ppg_preset)}
+        self.previous_timestamp = {preset: 0 for preset in (self.eeg_preset, self.gyro_preset, self.ppg_preset)}
+        # fft size that pocketfft handles efficiently, not necessarily a power of two.
+        self.psd_size = next_fast_len(self.eeg_sampling_rate, real=True)
+
+        # eeg filters as second-order sections, designed once and applied to all channels at once.
+        # Coefficients match the float32 eeg data, so filtering does not upcast it to float64.
+        # Only new samples are filtered, the filter states are kept in between updates, see _filter_new_eeg.
+        nyquist = self.eeg_sampling_rate / 2
+        self.sos_bp = signal.butter(2, [1.0 / nyquist, 59.0 / nyquist], btype='bandpass',
+                                    output='sos').astype(np.float32)
+        self.sos_bs = signal.butter(2, [48.0 / nyquist, 52.0 / nyquist], btype='bandstop',
+                                    output='sos').astype(np.float32)
+        self.bp_zi = None
+        self.bs_zi = None
+
+        # psd: the welch window and frequencies are fixed, so create them once.
+        # The psd frequencies are sorted and evenly spaced, so each band is a contiguous slice of the psd.
+        _, psd_freqs = _psd_plan(self.psd_size, self.eeg_sampling_rate)
+        # frequency slices of the delta, theta, alpha, beta and gamma bands, and the psd frequency resolution.
+        # Like Brainflow's get_band_power, a band runs from the first frequency at or above its lower bound up to and
+        # including the first frequency above its upper bound.
+        self.band_slices = [slice(int(np.searchsorted(psd_freqs, low)),
+                                  int(np.searchsorted(psd_freqs, high, 'right')) + 1)
+                            for low, high in [(1.0, 4.0), (4.0, 8.0), (8.0, 13.0), (13.0, 30.0), (30.0, 60.0)]]
+        self.psd_df = psd_freqs[1] - psd_freqs[0]
+        # channel locations used by the selfmade brain metrics, aligned with non_ref_channels.
+        self.frontal_mask = np.array(['Fp' in ch.name for ch in self.non_ref_channels])
+        self.parietal_mask = np.array(['TP' in ch.name and 'Fp' not in ch.name for ch in self.non_ref_channels])
 
         # selfmade power metrics
         self.set_parameters()
@@ -78,8 +329,6 @@ class IXRDashboard(Thread):
         self.inverse_workload_calib = [0, 1]
         self.inverse_workload_hist = [0, 1]
         self.inverse_workload = 0
-        self.engagement_calib = [0, 1]
-        self.engagement_hist = [0, 1]
         self.engagement = 0
         self.power_metrics = 0
 
@@ -89,6 +338,7 @@ class IXRDashboard(Thread):
         info_transmit = StreamInfo(name=name, type='IXR-metric', channel_count=1,
                                    channel_format=cf_double64, source_id='ixrflow_transmit_power')
         self.outlet_transmit = StreamOutlet(info_transmit)
+        self._lsl_sample = [0.0]  # reused for every pushed sample
         logging.info(f"'{self.outlet_transmit.get_info().name()}' Power Metric stream started.")
 
     def run(self):
@@ -101,11 +351,19 @@ class IXRDashboard(Thread):
         self._init_band_plot()
         self._init_brain_power_plot()
 
-        timer = QtCore.QTimer()
-        timer.timeout.connect(self._update)
-        timer.start(self.update_speed_ms)
+        # computations run in their own QThread, the GUI thread only plots their results.
+        self.compute_thread = QtCore.QThread()
+        self.compute_worker = ComputeWorker(self._compute, self.update_speed_ms)
+        self.compute_worker.moveToThread(self.compute_thread)
+        self.compute_thread.started.connect(self.compute_worker.start)
+        self.compute_worker.result_ready.connect(self._draw, QtCore.Qt.QueuedConnection)
+        self.compute_thread.start()
         QtGui.QApplication.instance().exec_()
 
+        QtCore.QMetaObject.invokeMethod(self.compute_worker, 'stop', QtCore.Qt.BlockingQueuedConnection)
+        self.compute_thread.quit()
+        self.compute_thread.wait()
+
     def set_parameters(self, calib_length: int = 600, power_length: int = 10, scale: float = 1.5,
                        offset: float = 0.5, head_impact: float = 0.2) -> None:
         """Allows setting ixr-flow metrics. Is called with defaults on object initialization.
@@ -127,6 +385,15 @@ class IXRDashboard(Thread):
         self.brain_center = offset
         self.head_impact = head_impact
 
+        # engagement calibration window, with its running mean and sum of squared deviations (Welford).
+        self.engagement_calib = deque([0, 1], maxlen=self.calib_length)
+        self._calib_mean = sum(self.engagement_calib) / len(self.engagement_calib)
+        self._calib_m2 = sum((x - self._calib_mean) ** 2 for x in self.engagement_calib)
+
+        # engagement history holds up to hist_length + 1 values, averaged with linearly increasing weights.
+        self.engagement_hist = deque([0, 1], maxlen=self.hist_length + 1)
+        self.weight_vec = np.arange(self.hist_length + 1, dtype=np.float64)
+
     def _init_pens(self) -> None:
         self.pens = list()
         self.brushes = list()
@@ -141,7 +408,7 @@ class IXRDashboard(Thread):
         self.plots = list()
         self.curves = list()
 
-        display_eeg_channels = [ch.name for ch in self.eeg_channels if ch.display]
+        display_eeg_channels = [ch.name for ch in self.display_channels]
 
         for i, channel_name in enumerate(display_eeg_channels):
             p = self.win.addPlot(row=i, col=0)
@@ -153,7 +420,8 @@ class IXRDashboard(Thread):
             p.setTitle(channel_name)
             self.plots.append(p)
             curve = p.plot(pen=self.pens[i % len(self.pens)])
-            # curve.setDownsampling(auto=True, method='mean', ds=3)
+            curve.setDownsampling(auto=True, method='peak', ds=3)
+            curve.setClipToView(True)
             self.curves.append(curve)
 
         axeslabels_gyro = ['gyro 1', 'gyro 2', 'gyro 3']
@@ -167,8 +435,8 @@ class IXRDashboard(Thread):
             p.setTitle(axeslabels_gyro[i])
             self.plots.append(p)
             curve = p.plot(pen=self.pens[i % len(self.pens)])
-            
-            # curve.setDownsampling(auto=True, method='mean', ds=3)
+            curve.setDownsampling(auto=True, method='peak', ds=3)
+            curve.setClipToView(True)
             self.curves.append(curve)
 
         axeslabels_ppg = ['heart']
@@ -181,7 +449,8 @@ class IXRDashboard(Thread):
         p.setTitle(axeslabels_ppg[0])
         self.plots.append(p)
         curve = p.plot(pen=self.pens[3])
-        # curve.setDownsampling(auto=True, method='mean', ds=3)
+        curve.setDownsampling(auto=True, method='peak', ds=3)
+        curve.setClipToView(True)
         self.curves.append(curve)
 
     def _init_psd(self) -> None:
@@ -235,72 +504,71 @@ class IXRDashboard(Thread):
         ay = self.power_plot.getAxis('bottom')
         ay.setTicks([tickdict.items()])
 
-    def _update(self) -> None:
+    def _compute(self) -> dict | None:
+        """Pulls data from Brainflow, computes all metrics, pushes the power metric over LSL and
+        returns everything that needs to be plotted. Runs in the compute thread, so it must not touch the GUI.
+
+        :return: Returns the data to plot, or None if there is no (usable) data yet.
+        :rtype: dict | None
+        """
         if not self.board_shim.is_prepared():
             # if no connection is established, abort this method.
-            return
+            return None
 
         try:
-            eeg_data = self.board_shim.get_current_board_data(int(self.plot_window_s * self.eeg_sampling_rate),
-                                                              self.eeg_preset)
-            gyro_data = self.board_shim.get_current_board_data(int(self.plot_window_s * self.gyro_sampling_rate),
-                                                               self.gyro_preset)[self.gyro_channels, :]
+            new_eeg_data = self._update_buffer(self.eeg_buffer, self.eeg_preset, self.eeg_sampling_rate,
+                                               self.eeg_rows)
+            self._filter_new_eeg(new_eeg_data)
+            self._update_buffer(self.gyro_buffer, self.gyro_preset, self.gyro_sampling_rate, self.gyro_channels)
             # Only pick the first of the PPG channels, which is channel 1 (zero indexed) of the board data array
-            ppg_data = self.board_shim.get_current_board_data(int(self.plot_window_s * self.ppg_sampling_rate),
-                                                              self.ppg_preset)[self.ppg_channels[0], :]
+            self._update_buffer(self.ppg_buffer, self.ppg_preset, self.ppg_sampling_rate, [self.ppg_channels[0]])
         except BrainFlowError as e:
             # Right after board preparation the Brainflow connection might be a bit unstable.
             # In that case Brainflow throws an INVALID_ARGUMENTS_ERROR exception.
             # If the case, abort method and try again later, but re-raise other exceptions.
             if e.exit_code == BrainFlowExitCodes.INVALID_ARGUMENTS_ERROR:
-                return
+                return None
             else:
                 raise e
 
         # Brainflow might still return empty arrays, abort method and try again later, if the case.
-        if len(eeg_data) < 1 or len(gyro_data) < 1 or len(ppg_data) < 1:
-            return
-        
-        # Perform bad channel detection
-        bad_channels = []
-        for eeg_channel in self.eeg_channels:
-            if eeg_channel.reference:
-                continue  # Skip reference channels
-            channel_data = eeg_data[eeg_channel.ch_number][-int(
-                self.power_metric_window_s * self.eeg_sampling_rate):]
+        if self.eeg_buffer.count < 1 or self.gyro_buffer.count < 1 or self.ppg_buffer.count < 1:
+            return None
 
-            # Apply bad channel detection criteria (example: detect channels with high variance)
+        # only copy the rows (and samples) that are needed out of the buffers
+        eeg_display = self.eeg_filtered_buffer.view(self.display_idx)
+        gyro_data = self.gyro_buffer.view()
+        ppg_data = self.ppg_buffer.view()[0]
 
-            #print('Detecting bad channel using line power ratio')
-            # Square channel_data
-            # channel_data_squared = np.square(channel_data)
-
-            # Calculate power spectral density using welch
-            freq, psd = signal.welch(channel_data, fs=self.eeg_sampling_rate)             
-
-            # Calculate line power ratio
-            line_power_ratio = 0.001 * (np.mean(psd[(freq > 45) & (freq < 55)]) + np.mean(psd[(freq > 95) & (freq < 105)])) / (np.mean(psd[(freq > 20) & (freq < 40)]) + np.mean(psd[(freq > 70) & (freq < 90)]))
-
-            #variance = np.var(channel_data_squared) / (500000 ** 2)
-            threshold_lpr = 0.0003 # 0.01
-            
-           # if line_power_ratio > threshold_lpr:
-               # print('bad channel',line_power_ratio,threshold_lpr)
-    
-            #else:
-                #print('good channel',line_power_ratio,threshold_lpr)
-
-            # Apply bad channel detection criteria (example: detect channels with high variance)
-         #   print('Detecting bad channel with high variance')
-            threshold = 0.04
-
-            variance = (np.var(channel_data))/500000
-        #    print('channel variance:', variance, 'threshold:', threshold, 'channel',eeg_channel.ch_number)
-
-            if variance > threshold:
-                bad_channels.append(eeg_channel)
+        # ppg: filter
+        DataFilter.detrend(ppg_data, DetrendOperations.CONSTANT.value)
+        DataFilter.perform_bandpass(data=ppg_data, sampling_rate=self.ppg_sampling_rate, start_freq=0.8,
+                                    stop_freq=4.0, order=4, filter_type=FilterTypes.BUTTERWORTH.value, ripple=0.0)
 
-      #  print('Number of bad chanels:', len(bad_channels))
+        # First few times _compute() runs there is not enough data yet to compute psd,
+        # if the case, skip bad channel detection and all metrics and only plot the time series.
+        if self.eeg_buffer.count < self.psd_size:
+            return {
+                'eeg': eeg_display,
+                'eeg_bad': [False] * len(self.display_channels),
+                'gyro': gyro_data,
+                'ppg': ppg_data,
+                'psd': None,
+                'bands': None,
+                'power': None,
+            }
+
+        # Perform bad channel detection, on all non-reference channels at once (channels x samples).
+        pm_samples = int(self.power_metric_window_s * self.eeg_sampling_rate)
+        raw_pm_block = self.eeg_buffer.view(self.non_ref_idx)  # the raw eeg buffer only holds the power metric window
+
+        # Apply bad channel detection criteria (example: detect channels with high variance)
+        threshold = 0.04
+        variance = raw_pm_block.var(axis=1) / 500000
+        bad_mask = variance > threshold
+        bad_ch_nums: set[int] = {ch.ch_number for ch, is_bad in zip(self.non_ref_channels, bad_mask) if is_bad}
+
+      #  print('Number of bad chanels:', len(bad_ch_nums))
 
         # Remove bad channels
         #good_channels = [ch for ch in self.eeg_channels if ch not in bad_channels]
@@ -310,86 +578,25 @@ class IXRDashboard(Thread):
         #eeg_data = eeg_data[good_channel_indices]
         #print(len(eeg_data))
 
-        # rereference
-        if self.reference == 'mean':
-            mean_channels = np.mean(eeg_data[[ch.ch_number for ch in self.eeg_channels if not ch.reference]], axis=0)
-            eeg_data[[ch.ch_number for ch in self.eeg_channels if not ch.reference]] -= mean_channels
-        elif self.reference == 'ref':
-            mean_reference_channels = np.mean(
-                eeg_data[[ch.ch_number for ch in self.eeg_channels if ch.reference]], axis=0)
-            eeg_data[[ch.ch_number for ch in self.eeg_channels if not ch.reference]] -= mean_reference_channels
-
-        # add gyro data to curves, leave first few curves for eeg data.
-        num_display_ch = len([ch for ch in self.eeg_channels if ch.display])
-        for count, _ in enumerate(self.gyro_channels):
-            self.curves[num_display_ch + count].setData(gyro_data[count].tolist())
-        head_movement = np.clip(np.mean(np.abs(gyro_data[:][-int(
-                self.power_metric_window_s * self.gyro_sampling_rate):])) / 50, 0, 1)
+        # gyro: slice the power metric window along the time axis first, then take the absolute values of that only.
+        gyro_pm_samples = int(self.power_metric_window_s * self.gyro_sampling_rate)
+        head_movement = np.clip(np.abs(gyro_data[:, -gyro_pm_samples:]).mean() / 50, 0, 1)
         #  power_metrics[2] = head_movement
 
-        # ppg: filter and add ppg to curves, again at the appropriate index.
-        DataFilter.detrend(ppg_data, DetrendOperations.CONSTANT.value)
-        DataFilter.perform_bandpass(data=ppg_data, sampling_rate=self.ppg_sampling_rate, start_freq=0.8,
-                                    stop_freq=4.0, order=4, filter_type=FilterTypes.BUTTERWORTH.value, ripple=0.0)
-        self.curves[num_display_ch + gyro_data.shape[0]].setData(ppg_data.tolist())
-
-        # eeg processing
-        avg_bands = [0, 0, 0, 0, 0]
-        frontal_theta = 1
-        parietal_alpha = 1
-        engagement_idx = 0
-
-        for graph_number, eeg_channel in enumerate([ch for ch in self.eeg_channels if ch.display]):
-            DataFilter.detrend(eeg_data[eeg_channel.ch_number], DetrendOperations.CONSTANT.value)
-            DataFilter.perform_bandpass(data=eeg_data[eeg_channel.ch_number], sampling_rate=self.eeg_sampling_rate, start_freq=1.0,
-                                        stop_freq=59.0, order=2, filter_type=FilterTypes.BUTTERWORTH.value, ripple=0.0)
-            DataFilter.perform_bandstop(data=eeg_data[eeg_channel.ch_number], sampling_rate=self.eeg_sampling_rate, start_freq=48.0,
-                                        stop_freq=52.0, order=2, filter_type=FilterTypes.BUTTERWORTH.value, ripple=0.0)
-            # plot timeseries
-            colors = ['#e9c46a', '#f4a261', '#e76f51', '#d62828']
-            if eeg_channel in bad_channels:
-                self.curves[graph_number].setData(eeg_data[eeg_channel.ch_number].tolist(), pen='w')
-            else:
-                self.curves[graph_number].setData(eeg_data[eeg_channel.ch_number].tolist(), pen=colors[graph_number]) 
-
-            # take/slice the last samples of eeg_data that fall within the power metric window
-            eeg_data_pm_sliced = eeg_data[eeg_channel.ch_number][-int(
-                self.power_metric_window_s * self.eeg_sampling_rate):]
-            if len(eeg_data_pm_sliced) < self.psd_size:
-                continue  # First time _update() runs there is not enough data yet to compute psd
-
-            if not eeg_channel.reference:
-                # compute psd
-                psd_data = DataFilter.get_psd_welch(data=eeg_data_pm_sliced,
-                                                    nfft=self.psd_size,
-                                                    overlap=self.psd_size // 2,
-                                                    sampling_rate=self.eeg_sampling_rate,
-                                                    window=WindowOperations.BLACKMAN_HARRIS.value)
-
-                lim = min(48, len(psd_data[0]))
-                self.psd_curves[graph_number].setData(psd_data[1][0:lim].tolist(), psd_data[0][0:lim].tolist())
-                # compute bands
-                delta = DataFilter.get_band_power(psd_data, 1.0, 4.0)
-                theta = DataFilter.get_band_power(psd_data, 4.0, 8.0)
-                alpha = DataFilter.get_band_power(psd_data, 8.0, 13.0)
-                beta = DataFilter.get_band_power(psd_data, 13.0, 30.0)
-                gamma = DataFilter.get_band_power(psd_data, 30.0, 60.0)
-                avg_bands[0] = avg_bands[0] + delta
-                avg_bands[1] = avg_bands[1] + theta
-                avg_bands[2] = avg_bands[2] + alpha
-                avg_bands[3] = avg_bands[3] + beta
-                avg_bands[4] = avg_bands[4] + gamma
-
-                # compute selfmade brain metrics
-                if eeg_channel in bad_channels:
-                    continue
-                else:
-                    engagement_idx += (beta / (theta + alpha)) / gamma
-
-                if 'Fp' in eeg_channel.name:
-                    frontal_theta += theta / gamma
-                elif 'TP' in eeg_channel.name:
-                    parietal_alpha += alpha / gamma
+        # eeg processing, take/slice the last samples of the filtered non-reference channels
+        # that fall within the power metric window
+        pm_block = self.eeg_filtered_buffer.view(self.non_ref_idx, pm_samples)
+
+        # compute psd, bands (channels x bands) and selfmade brain metrics of all channels at once
+        freqs, psd, bands, engagement_idx, frontal_sum, parietal_sum = _compute_metrics(
+            pm_block, self.eeg_sampling_rate, self.psd_size, self.band_slices, self.psd_df,
+            ~bad_mask, self.frontal_mask, self.parietal_mask)
+        avg_bands = bands.sum(axis=0)
+        frontal_theta = 1 + frontal_sum
+        parietal_alpha = 1 + parietal_sum
+
+        lim = min(48, len(freqs))
+        psd_plot_data = (freqs[0:lim], psd[:, 0:lim])
 
         avg_bands = [int(x / len(self.eeg_channels)) for x in avg_bands]  # average bands were just sums
 
@@ -405,46 +612,166 @@ class IXRDashboard(Thread):
             #elif 'TP' in channels:
                 #parietal_channels.append(eeg_channel)
 
-        if len(bad_channels)!=4:
-            engagement_idx = engagement_idx / (4-len(bad_channels))
+        if len(bad_ch_nums)!=4:
+            engagement_idx = engagement_idx / (4-len(bad_ch_nums))
         else:
             engagement_idx = 0
         
-        print(engagement_idx)
+        logging.debug("Engagement index: %f", engagement_idx)
         parietal_alpha = parietal_alpha / 2
         frontal_theta = frontal_theta / 2
 
-        # engagement
-        self.engagement_calib.append(engagement_idx)
-        if len(self.engagement_calib) > self.calib_length:
-            del self.engagement_calib[0]
-
-        if len(self.engagement_hist) > self.hist_length:
-            del self.engagement_hist[0]
-
-        # scale
-        engagement_z = (engagement_idx - np.mean(self.engagement_calib)) / np.std(self.engagement_calib)
-        engagement_z /= 2 * self.brain_scale
-        engagement_z += self.brain_center
-        engagement_z = np.clip(engagement_z, 0.05, 1)
-        self.engagement_hist.append(engagement_z)
-
-        # weighted mean
-        engagement_weighted_mean = 0
-        sumweight = 0
-        for count, hist_val in enumerate(self.engagement_hist):
-            engagement_weighted_mean += hist_val * count
-            sumweight += count
-
-        engagement_weighted_mean = engagement_weighted_mean / sumweight
-
-        self.engagement = engagement_weighted_mean
-        self.power_metrics = np.float32(self.engagement + (1 - head_movement) * self.head_impact)
+        # a non-finite index (e.g. from a flat channel) would corrupt the running statistics for good,
+        # skip it and keep the previous power metric.
+        if not np.isfinite(engagement_idx):
+            logging.debug("Skipping non-finite engagement index")
+        else:
+            # engagement, update the calibration statistics with Welford's algorithm.
+            # A full deque drops its oldest value on append, in that case the new value replaces the oldest one.
+            if len(self.engagement_calib) == self.engagement_calib.maxlen:
+                oldest = self.engagement_calib[0]
+                previous_mean = self._calib_mean
+                self._calib_mean += (engagement_idx - oldest) / len(self.engagement_calib)
+                self._calib_m2 += ((engagement_idx - oldest)
+                                   * (engagement_idx - self._calib_mean + oldest - previous_mean))
+                self.engagement_calib.append(engagement_idx)
+            else:
+                self.engagement_calib.append(engagement_idx)
+                delta = engagement_idx - self._calib_mean
+                self._calib_mean += delta / len(self.engagement_calib)
+                self._calib_m2 += delta * (engagement_idx - self._calib_mean)
+
+            # scale, population standard deviation like np.std
+            calib_std = np.sqrt(max(self._calib_m2, 0.0) / len(self.engagement_calib))
+            engagement_z = (engagement_idx - self._calib_mean) / calib_std
+            engagement_z /= 2 * self.brain_scale
+            engagement_z += self.brain_center
+            engagement_z = np.clip(engagement_z, 0.05, 1)
+            self.engagement_hist.append(engagement_z)
+
+            # weighted mean
+            hist = np.asarray(self.engagement_hist)
+            weights = self.weight_vec[:len(hist)]
+            engagement_weighted_mean = hist @ weights / weights.sum()
+
+            self.engagement = engagement_weighted_mean
+            self.power_metrics = float(self.engagement + (1 - head_movement) * self.head_impact)
+
+            self._lsl_sample[0] = self.power_metrics
+            self.outlet_transmit.push_sample(self._lsl_sample)
+
+        return {
+            'eeg': eeg_display,  # displayed channels x samples
+            'eeg_bad': [eeg_channel.ch_number in bad_ch_nums for eeg_channel in self.display_channels],
+            'gyro': gyro_data,
+            'ppg': ppg_data,
+            'psd': psd_plot_data,
+            'bands': avg_bands,
+            'power': self.power_metrics,
+        }
+
+    def _filter_new_eeg(self, eeg_chunk: npt.NDArray[np.float64]) -> None:
+        """Re-references and filters new eeg samples and adds them to the filtered eeg buffer.
+        The filter states are kept in between calls, so only the new samples have to be filtered.
+
+        :param eeg_chunk: New eeg samples, rows follow eeg_channels, channels x samples.
+        :type eeg_chunk: npt.NDArray[np.float64]
+        """
+        if eeg_chunk.shape[1] < 1:
+            return
+        eeg_chunk = eeg_chunk.astype(np.float32)
+
+        # rereference, re-referencing is per sample, so it can be done on the new samples only.
+        # Gather the non-reference channels once, subtract in place and scatter them back.
+        if self.reference in ('mean', 'ref'):
+            non_ref_data = eeg_chunk[self.non_ref_idx]
+            if self.reference == 'mean':
+                non_ref_data -= non_ref_data.mean(axis=0)
+            else:
+                non_ref_data -= eeg_chunk[self.ref_idx].mean(axis=0)
+            eeg_chunk[self.non_ref_idx] = non_ref_data
+
+        if self.bp_zi is None:
+            # start the filters in the steady state of the first sample, to prevent an onset transient.
+            # The bandpass output of a constant input is zero, so the bandstop starts at rest.
+            # States are sections x channels x 2, in float32 so filtering does not upcast the data.
+            self.bp_zi = (signal.sosfilt_zi(self.sos_bp)[:, np.newaxis, :]
+                          * eeg_chunk[np.newaxis, :, 0, np.newaxis]).astype(np.float32)
+            self.bs_zi = np.zeros((len(self.sos_bs), len(eeg_chunk), 2), dtype=np.float32)
+        eeg_chunk, self.bp_zi = signal.sosfilt(self.sos_bp, eeg_chunk, axis=-1, zi=self.bp_zi)
+        eeg_chunk, self.bs_zi = signal.sosfilt(self.sos_bs, eeg_chunk, axis=-1, zi=self.bs_zi)
+        self.eeg_filtered_buffer.extend(eeg_chunk)
+
+    def _update_buffer(self, buffer: RingBuffer, preset: BrainFlowPresets, sampling_rate: int,
+                       rows: list[int]) -> npt.NDArray[np.float64]:
+        """Pulls the samples that arrived since the previous call from Brainflow and adds the given rows to buffer.
+        Uses timestamps to find the new samples, because other threads read from the same Brainflow buffer.
+
+        :param buffer: Ring buffer to add the new samples to.
+        :type buffer: RingBuffer
+        :param preset: Brainflow preset to pull data from.
+        :type preset: BrainFlowPresets
+        :param sampling_rate: Sampling rate of the preset.
+        :type sampling_rate: int
+        :param rows: Rows of the board data array to add to the buffer.
+        :type rows: list[int]
+        :return: Returns the new samples of the given rows, channels x samples.
+        :rtype: npt.NDArray[np.float64]
+        """
+        timestamp_channel = self.timestamp_channels[preset]
+        data = self.board_shim.get_current_board_data(int(self.pull_window_s * sampling_rate), preset)
+        if data.shape[1] > 0 and data[timestamp_channel, 0] > self.previous_timestamp[preset]:
+            # The previous pull is longer ago than pull_window_s (or this is the first one),
+            # pull the whole plot window to not miss any samples.
+            data = self.board_shim.get_current_board_data(int(self.plot_window_s * sampling_rate), preset)
+
+        # slice columns with timestamps bigger then previous_timestamp
+        data = data[:, data[timestamp_channel] > self.previous_timestamp[preset]]
+        new_data = data[rows]
+        if data.shape[1] > 0:
+            self.previous_timestamp[preset] = data[timestamp_channel, -1]
+            buffer.extend(new_data)
+        return new_data
+
+    def _draw(self, result: dict) -> None:
+        """Plots the results of _compute, runs in the GUI thread.
+
+        :param result: Data to plot, as returned by _compute.
+        :type result: dict
+        """
+        try:
+            self._draw_result(result)
+        finally:
+            self.compute_worker.result_drawn()
 
-        # plot bars
-        self.band_bar.setOpts(height=avg_bands)
-        self.power_bar.setOpts(height=self.power_metrics)
+    def _draw_result(self, result: dict) -> None:
+        """Plots a single result, see _draw.
 
-        self.outlet_transmit.push_sample([self.power_metrics])
+        :param result: Data to plot, as returned by _compute.
+        :type result: dict
+        """
+        # plot timeseries
+        colors = ['#e9c46a', '#f4a261', '#e76f51', '#d62828']
+        for graph_number, (eeg_channel_data, is_bad) in enumerate(zip(result['eeg'], result['eeg_bad'])):
+            if is_bad:
+                self.curves[graph_number].setData(eeg_channel_data, pen='w')
+            else:
+                self.curves[graph_number].setData(eeg_channel_data, pen=colors[graph_number])
 
-        self.app.processEvents()
+        # add gyro data to curves, leave first few curves for eeg data.
+        num_display_ch = len(self.display_channels)
+        for count, gyro_channel_data in enumerate(result['gyro']):
+            self.curves[num_display_ch + count].setData(gyro_channel_data)
+
+        # add ppg to curves, again at the appropriate index.
+        self.curves[num_display_ch + len(result['gyro'])].setData(result['ppg'])
+
+        # First few times there is not enough data yet to compute psd and metrics
+        if result['psd'] is not None:
+            freqs, psd = result['psd']
+            for graph_number, psd_channel_data in enumerate(psd):
+                self.psd_curves[graph_number].setData(freqs, psd_channel_data)
+
+            # plot bars
+            self.band_bar.setOpts(height=result['bands'])
+            self.power_bar.setOpts(height=result['power'])